@@ -10,24 +10,39 @@ It takes advantage of the XML format of the ClassAds in order to make parsing
 easier.
 """
 
+import re
 import sys
 import os
+import shlex
+import subprocess
 import gip_sets as sets
 import time
 import types
 import cStringIO
-import xml
-from xml.sax import make_parser, SAXParseException
-from xml.sax.handler import ContentHandler, feature_external_ges
+from xml.sax import SAXParseException, SAXNotRecognizedException
+from xml.sax.expatreader import ExpatParser
+from xml.sax.handler import ContentHandler, feature_external_ges, \
+    feature_external_pes, feature_namespaces
+try:
+    from lxml import etree
+    _etree_is_lxml = True
+except ImportError:
+    _etree_is_lxml = False
+    try:
+        import xml.etree.cElementTree as etree
+    except ImportError:
+        etree = None
 
 from gip_common import voList, cp_getBoolean, getLogger, cp_get, voList, \
     VoMapper, cp_getInt, cp_getList, isDefined, addToPath
+import gip_testing
 from gip_testing import runCommand
 
 condor_version = "condor_version"
 condor_group = "condor_config_val %(daemon)s GROUP_NAMES"
 condor_quota = "condor_config_val %(daemon)s GROUP_QUOTA_%(group)s"
 condor_prio = "condor_config_val %(daemon)s GROUP_PRIO_FACTOR_%(group)s"
+condor_group_config = "condor_config_val %(daemon)s %(names)s"
 condor_status = "condor_status -xml -constraint '%(constraint)s'"
 condor_status_submitter = "condor_status -submitter -xml -constraint '%(constraint)s'"
 condor_job_status = "condor_q -xml -constraint '%(constraint)s'"
@@ -46,40 +61,55 @@ class ClassAdParser(ContentHandler):
     Condor attribute passed in as 'idx' to the constructor; the value is another
     dictionary of key-value pairs from the condor JDL, where the keys is in
     the attribute list passed to the constructor.
+
+    If an on_classad callback is passed to the constructor, each classad is
+    handed to it as soon as it is parsed instead of being stored, so the
+    dictionary of jobs stays empty.  As with the dictionary, each index is
+    only counted once; the first classad with a given index is passed on,
+    and later ones with the same index are dropped.
     """
 
-    def __init__(self, idx, attrlist=None): #pylint: disable-msg=W0231
+    def __init__(self, idx, attrlist=None, on_classad=None): #pylint: disable-msg=W0231
         """
         @param idx: The attribute name used to index the classads with.
         @keyword attrlist: A list of attributes to record; if it is empty, then
            parse all attributes.
+        @keyword on_classad: A function called as on_classad(idx, info) for
+           each classad with a new index, where idx is its index and info is
+           the dictionary of its attributes.
         """
         if not attrlist:
             self.attrlist = []
         else:
             self.attrlist = list(attrlist)
-        if isinstance(idx, types.TupleType) and self.attrlist:
-            for name in idx:
-                if name not in self.attrlist:
-                    self.attrlist.append(name)
-        if self.attrlist and idx not in self.attrlist:
+        if isinstance(idx, types.TupleType):
+            if self.attrlist:
+                for name in idx:
+                    if name not in self.attrlist:
+                        self.attrlist.append(name)
+        elif self.attrlist and idx not in self.attrlist:
             self.attrlist.append(idx)
+        self.attrset = frozenset(self.attrlist)
         self.idxAttr = idx
+        self.on_classad = on_classad
         self.caInfo = {}
-        self.attrInfo = ''
+        self._seen = sets.Set()
+        self._buf = []
         # Initialize some used class variables.
         self._starttime = time.time()
         self._endtime = time.time()
         self._elapsed = 0
         self.curCaInfo = {}
         self.attrName = ''
+        self._wanted = False
         
     def startDocument(self):
         """
         Start up a parsing sequence; initialize myself.
         """
-        self.attrInfo = ''
+        self._buf = []
         self.caInfo = {}
+        self._seen = sets.Set()
         self._starttime = time.time()
    
     def endDocument(self):
@@ -88,7 +118,7 @@ class ClassAdParser(ContentHandler):
         """
         self._endtime = time.time()
         self._elapsed = self._endtime - self._starttime
-        myLen = len(self.caInfo)
+        myLen = len(self.caInfo) + len(self._seen)
         log.info("Processed %i classads in %.2f seconds; %.2f classads/" \
                  "second" % (myLen,
                              self._elapsed, myLen/(self._elapsed+1e-10)))
@@ -101,8 +131,11 @@ class ClassAdParser(ContentHandler):
         if name == 'c':
             self.curCaInfo = {}
         elif name == 'a':
-            self.attrName = str(attrs.get('n', 'Unknown'))
-            self.attrInfo = ''
+            attrName = attrs.get('n', 'Unknown')
+            self._wanted = not self.attrset or attrName in self.attrset
+            if self._wanted:
+                self.attrName = str(attrName)
+                self._buf = []
         else:
             pass
 
@@ -118,22 +151,37 @@ class ClassAdParser(ContentHandler):
                     if idx:
                         full_idx += (idx,)
                 if len(full_idx) == len(self.idxAttr):
-                    self.caInfo[full_idx] = self.curCaInfo
+                    self.addClassAd(full_idx, self.curCaInfo)
             else:
                 idx = self.curCaInfo.get(self.idxAttr, None)
                 if idx:
-                    self.caInfo[idx] = self.curCaInfo
+                    self.addClassAd(idx, self.curCaInfo)
         elif name == 'a':
-            if self.attrName in self.attrlist or len(self.attrlist) == 0:
-                self.curCaInfo[self.attrName] = self.attrInfo
+            if self._wanted:
+                self.curCaInfo[self.attrName] = str(''.join(self._buf))
+                self._wanted = False
         else:
             pass
 
+    def addClassAd(self, idx, info):
+        """
+        Record a completed classad, or pass it on to the on_classad callback
+        if no classad with the same index has been seen in this document.
+        """
+        if self.on_classad is None:
+            self.caInfo[idx] = info
+        elif idx not in self._seen:
+            self._seen.add(idx)
+            self.on_classad(idx, info)
+
     def characters(self, ch):
         """
-        Save up the XML characters found in the attribute.
+        Save up the XML characters found in the attribute; they are joined
+        together once the attribute ends.  Characters outside of a wanted
+        attribute are dropped immediately.
         """
-        self.attrInfo += str(ch)
+        if self._wanted:
+            self._buf.append(ch)
 
     def getClassAds(self):
         """
@@ -142,25 +190,210 @@ class ClassAdParser(ContentHandler):
         """
         return self.caInfo
 
-def parseCondorXml(fp, handler): #pylint: disable-msg=C0103
+# Error messages from cElementTree and lxml for empty or truncated documents.
+_truncated_xml_messages = ['no element found', 'Document is empty',
+    'Premature end of data']
+
+def _elementText(elem): #pylint: disable-msg=C0103
     """
-    Parse XML from Condor.
+    Return all the text inside B{elem}, like the itertext method of lxml and
+    ElementTree 1.3, which the cElementTree of Python 2.5 and 2.6 lacks.
+    """
+    text = [elem.text or '']
+    for child in elem:
+        text.append(_elementText(child))
+        text.append(child.tail or '')
+    return ''.join(text)
 
-    Create a SAX parser with the content handler B{handler}, then parse the
-    contents of B{fp} with it.
+def _iterparseCondorXml(fp, handler): #pylint: disable-msg=C0103
+    """
+    Parse XML from Condor using the C-level iterparse of lxml (or
+    cElementTree), filling in the ClassAdParser B{handler} directly.
+
+    Only the end of each 'a' and 'c' element is examined; each classad is
+    cleared once recorded so memory use stays flat for large documents.
+    With lxml, the cleared classads are also removed from the root, and
+    entities are never resolved.
+    """
+    handler.startDocument()
+    if _etree_is_lxml:
+        events = etree.iterparse(fp, resolve_entities=False)
+    else:
+        events = etree.iterparse(fp)
+    try:
+        for _, elem in events:
+            if elem.tag == 'a':
+                name = elem.get('n', 'Unknown')
+                if not handler.attrset or name in handler.attrset:
+                    handler.curCaInfo[name] = _elementText(elem)
+            elif elem.tag == 'c':
+                handler.endElement('c')
+                handler.curCaInfo = {}
+                elem.clear()
+                if _etree_is_lxml:
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+    except SyntaxError, e:
+        # Empty or truncated output from Condor; keep what we have, as the
+        # SAX parser does for 'no element found'.
+        for msg in _truncated_xml_messages:
+            if str(e).find(msg) >= 0:
+                return
+        raise
+    handler.endDocument()
+
+# The Condor -xml dialect: each <a n="..."> holds a single typed value, such
+# as <s>text</s>, <i>1</i> or <b v="t"/>, and each classad ends with </c>.
+# Plain values like <i>1</i> or <s>Claimed</s> are captured as they are (the
+# second group); anything else (the third group) has its tags stripped and
+# its entities and character references decoded by the scanner.
+_classad_value = r'(?:<[a-z]+>([^<&]*)</[a-z]+>|(.*?))</a>'
+_classad_re = re.compile(r'<a n="([^"]*)">%s|</c>' % _classad_value, re.S)
+_classad_re_cache = {}
+_scan_block_size = 1024*1024
+_xml_tag_re = re.compile(r'<[^>]*>')
+_xml_entity_re = re.compile(r'&(#[0-9]+|#x[0-9a-fA-F]+|amp|lt|gt|quot|apos);')
+_xml_entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+def _unescapeEntity(m): #pylint: disable-msg=C0103
+    """
+    Return the text for the entity or character reference matched by
+    _xml_entity_re; characters outside of ASCII are encoded as UTF-8.
+    """
+    name = m.group(1)
+    if name[:2] == '#x':
+        code = int(name[2:], 16)
+    elif name[:1] == '#':
+        code = int(name[1:])
+    else:
+        return _xml_entities[name]
+    if code < 128:
+        return chr(code)
+    try:
+        return unichr(code).encode('utf-8')
+    except ValueError:
+        return m.group(0)
+
+def _getClassAdRe(attrset): #pylint: disable-msg=C0103
+    """
+    Return the regular expression matching the attributes in B{attrset} (or
+    all attributes, if it is empty) and the end of each classad.
+
+    Unwanted attributes are skipped inside the regular expression engine, so
+    they never cost a Python-level match object.
+    """
+    if not attrset:
+        return _classad_re
+    pattern = _classad_re_cache.get(attrset, None)
+    if pattern is None:
+        names = [re.escape(name) for name in attrset]
+        names.sort()
+        pattern = re.compile(r'<a n="(%s)">%s|</c>' % ('|'.join(names),
+            _classad_value), re.S)
+        _classad_re_cache[attrset] = pattern
+    return pattern
+
+def _scanCondorXml(fp, handler, data=''): #pylint: disable-msg=C0103
+    """
+    Scan the XML output of Condor with regular expressions, filling in the
+    ClassAdParser B{handler} directly.
+
+    The output is read in blocks which are split on classad boundaries
+    ('</c>'), so only one block needs to be held in memory at a time.
+
+    This only understands the fixed, shallow layout of condor_* -xml output
+    and does no validation; it is used for non-strict parses only.
 
     @param fp: A file-like object of the Condor XML data
+    @param handler: The ClassAdParser to fill in.
+    @keyword data: Data already read from the beginning of B{fp}.
+    """
+    handler.startDocument()
+    classad_re = _getClassAdRe(handler.attrset)
+    cur = handler.curCaInfo = {}
+    while True:
+        block = fp.read(_scan_block_size)
+        data += block
+        if block:
+            end = data.rfind('</c>')
+            if end < 0:
+                continue
+            end += 4
+            chunk, data = data[:end], data[end:]
+        else:
+            chunk = data
+        for m in classad_re.finditer(chunk):
+            name, value, raw = m.groups()
+            if name is None:
+                handler.endElement('c')
+                cur = handler.curCaInfo = {}
+            elif value is not None:
+                cur[name] = value
+            else:
+                value = _xml_tag_re.sub('', raw)
+                if value.find('&') >= 0:
+                    value = _xml_entity_re.sub(_unescapeEntity, value)
+                cur[name] = value
+        if not block:
+            break
+    handler.endDocument()
+
+_sax_parser = None
+def _getSaxParser(): #pylint: disable-msg=C0103
+    """
+    Return the SAX parser used for Condor XML, creating it on first use.
+
+    This is always the expat parser; Condor XML has no namespaces and no
+    external entities, so all processing of those is turned off.  The same
+    parser is reused for every document; it resets its internal state at the
+    start of each parse.
+    """
+    global _sax_parser #pylint: disable-msg=W0603
+    if _sax_parser is None:
+        _sax_parser = ExpatParser()
+        for feature in [feature_namespaces, feature_external_ges,
+                feature_external_pes]:
+            try:
+                _sax_parser.setFeature(feature, False)
+            except SAXNotRecognizedException:
+                pass
+    return _sax_parser
+
+def parseCondorXml(fp, handler, strict=True): #pylint: disable-msg=C0103
+    """
+    Parse XML from Condor.
+
+    If B{handler} is a ClassAdParser and lxml or cElementTree is available,
+    the document is parsed with iterparse; otherwise, create a SAX parser with
+    the content handler B{handler}, then parse the contents of B{fp} with it.
+
+    If B{strict} is False and B{handler} is a ClassAdParser, the document is
+    instead scanned with regular expressions which only understand the
+    output of the condor_* -xml commands; documents that do not look like
+    Condor output go through the normal parser.
+
+    @param fp: A file-like object or a string of the Condor XML data
     @param handler: An object which will be our content handler.
     @type handler: xml.sax.handler.ContentHandler
+    @keyword strict: Set to False to allow the faster, non-validating scanner.
     @returns: None
     """
-    parser = make_parser()
+    if isinstance(fp, types.StringType):
+        fp = cStringIO.StringIO(fp)
+
+    if not strict and isinstance(handler, ClassAdParser):
+        data = fp.read(_scan_block_size)
+        if data.find('<classads>') >= 0:
+            _scanCondorXml(fp, handler, data)
+            return
+        fp = cStringIO.StringIO(data + fp.read())
+
+    if etree is not None and isinstance(handler, ClassAdParser):
+        _iterparseCondorXml(fp, handler)
+        return
+
+    parser = _getSaxParser()
     parser.setContentHandler(handler)
-    try:
-        parser.setFeature(feature_external_ges, False)
-    except xml.sax._exceptions.SAXNotRecognizedException:
-        pass
-    
     try:
         parser.parse(fp)
     except SAXParseException, e:
@@ -186,10 +419,34 @@ def _createSubmitterConstraint(cp):
         
     return submitConstraint
     
-def condorCommand(command, cp, info=None): #pylint: disable-msg=W0613
+def _exec(argv): #pylint: disable-msg=C0103
     """
-    Execute a command in the shell.  Returns a file-like object
-    containing the stdout of the command
+    Execute the command B{argv} directly, without going through a shell, and
+    return a file-like object containing its stdout.
+
+    Failures are logged and result in empty output, as with runCommand.
+    """
+    try:
+        child = subprocess.Popen(argv, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    except OSError, e:
+        log.info("Unable to execute %s: %s" % (' '.join(argv), e))
+        return cStringIO.StringIO()
+    stdout, stderr = child.communicate()
+    if child.returncode:
+        log.info("Command %s exited with %d, stderr: %s" % (' '.join(argv),
+            child.returncode, stderr))
+    return cStringIO.StringIO(stdout)
+
+_command_cache = {}
+def condorCommand(command, cp, info=None, cache=False): #pylint: disable-msg=W0613
+    """
+    Execute a command.  Returns a file-like object containing the stdout of
+    the command.
+
+    The command line is split with shell quoting rules and executed directly,
+    without a shell.  When the testing framework replaces commands with saved
+    output (gip_testing.replace_command), it goes through runCommand instead.
 
     Use this function instead of executing directly (os.popen); this will
     allow you to hook your providers into the testing framework.
@@ -197,6 +454,9 @@ def condorCommand(command, cp, info=None): #pylint: disable-msg=W0613
     @param command: The command to execute
     @param cp: The GIP configuration object
     @keyword info: A dictionary-like object for Python string substitution
+    @keyword cache: If True, remember the output of the command and reuse it
+        for later identical invocations; only use this for commands whose
+        output does not change during the lifetime of the process.
     @returns: a file-like object.
     """
 
@@ -207,24 +467,56 @@ def condorCommand(command, cp, info=None): #pylint: disable-msg=W0613
         cmd = command % info
     else:
         cmd = command
+    if cache and cmd in _command_cache:
+        log.debug("Using cached output of command %s." % cmd)
+        return cStringIO.StringIO(_command_cache[cmd])
     log.debug("Running command %s." % cmd)
 
-    return runCommand(cmd)
+    if gip_testing.replace_command:
+        fp = runCommand(cmd)
+    else:
+        fp = _exec(shlex.split(cmd))
+    if cache:
+        _command_cache[cmd] = fp.read()
+        return cStringIO.StringIO(_command_cache[cmd])
+    return fp
+
+def condorCommandBytes(command, cp, info=None): #pylint: disable-msg=C0103
+    """
+    Execute a command like condorCommand and return its entire stdout as a
+    string.
+
+    The output is read in one go, so it can be handed to parseCondorXml
+    without many small reads from the command's pipe.
 
+    @param command: The command to execute
+    @param cp: The GIP configuration object
+    @keyword info: A dictionary-like object for Python string substitution
+    @returns: The output of the command.
+    @rtype: string
+    """
+    return condorCommand(command, cp, info).read()
+
+_version_cache = None
 def getLrmsInfo(cp): #pylint: disable-msg=C0103
     """
     Get information from the LRMS (batch system).
 
-    Returns the version of the condor client on your system.
+    Returns the version of the condor client on your system.  The version is
+    only queried once per process.
 
     @returns: The condor version
     @rtype: string
     """
+    global _version_cache #pylint: disable-msg=W0603
+    if _version_cache:
+        return _version_cache
 
     for line in condorCommand(condor_version, cp):
         if line.startswith("$CondorVersion:"):
             version = line[15:].strip()
             log.info("Running condor version %s." % version)
+            _version_cache = version
             return version
     ve = ValueError("Bad output from condor_version.")
     log.exception(ve)
@@ -252,7 +544,7 @@ def getGroupInfo(vo_map, cp): #pylint: disable-msg=C0103,W0613
         else:
             configDaemon = "-negotiator"
                                     
-    fp = condorCommand(condor_group, cp, {'daemon' : configDaemon})
+    fp = condorCommand(condor_group, cp, {'daemon' : configDaemon}, cache=True)
     output = fp.read().split(',')
     if fp.close():
         log.info("No condor groups found.")
@@ -281,27 +573,74 @@ def getGroupInfo(vo_map, cp): #pylint: disable-msg=C0103,W0613
     retval = {}
     if (not (grouplist[0].startswith('Not defined'))) and \
             (len(grouplist[0]) > 0):
+        groupConfig = _getGroupConfig(grouplist, configDaemon, cp)
         for group in grouplist:
-            quota = condorCommand(condor_quota, cp, \
-                {'group': group, 'daemon': configDaemon}).read().strip()
-            prio = condorCommand(condor_prio, cp, \
-                {'group': group, 'daemon': configDaemon}).read().strip()
+            quota, prio = groupConfig[group]
             vos = guessVO(cp, group)
             if not vos:
                 continue
             curInfo = {'quota': 0, 'prio': 0, 'vos': vos}
-            try:
+            if _isInteger(quota):
                 curInfo['quota'] += int(quota)
-            except:
-                pass
-            try:
+            else:
+                log.debug("Ignoring non-integer quota %s for group %s." % \
+                    (quota, group))
+            if _isInteger(prio):
                 curInfo['prio'] += int(prio)
-            except:
-                pass
+            else:
+                log.debug("Ignoring non-integer priority factor %s for group" \
+                    " %s." % (prio, group))
             retval[group] = curInfo
     log.debug("The condor groups are %s." % ', '.join(retval.keys()))
     return retval
 
+def _isInteger(value): #pylint: disable-msg=C0103
+    """
+    Return True if the string B{value} is a plain (possibly negative) integer
+    which int() can convert.
+    """
+    if value[:1] == '-':
+        value = value[1:]
+    return value.isdigit()
+
+def _getGroupConfig(grouplist, configDaemon, cp): #pylint: disable-msg=C0103
+    """
+    Get the quota and priority factor of each condor group.
+
+    All the values are requested with a single condor_config_val invocation;
+    if that does not return one line per value (for example, when one of the
+    values is not defined), fall back to querying each value separately.
+
+    @param grouplist: List of condor group names
+    @param configDaemon: The daemon argument to pass to condor_config_val
+    @param cp: A ConfigParse object with the GIP config information
+    @returns: A dictionary whose keys are the group names and values are
+        (quota, prio) tuples of the unparsed condor_config_val output.
+    """
+    names = []
+    for group in grouplist:
+        names.append("GROUP_QUOTA_%s" % group)
+        names.append("GROUP_PRIO_FACTOR_%s" % group)
+    fp = condorCommand(condor_group_config, cp, {'daemon': configDaemon,
+        'names': ' '.join(names)}, cache=True)
+    output = [line.strip() for line in fp.read().splitlines()]
+
+    retval = {}
+    if len(output) == len(names):
+        for idx in range(len(grouplist)):
+            retval[grouplist[idx]] = output[2*idx], output[2*idx+1]
+        return retval
+
+    log.debug("Batched condor_config_val query failed; querying each group" \
+        " separately.")
+    for group in grouplist:
+        quota = condorCommand(condor_quota, cp, \
+            {'group': group, 'daemon': configDaemon}, cache=True).read().strip()
+        prio = condorCommand(condor_prio, cp, \
+            {'group': group, 'daemon': configDaemon}, cache=True).read().strip()
+        retval[group] = quota, prio
+    return retval
+
 def doPath(cp):
     # add condor binaries to system path
     
@@ -448,18 +787,20 @@ def _getJobsInfoInternal(cp):
     if _results_cache:
         return dict(_results_cache)
     constraint = cp_get(cp, "condor", "jobs_constraint", "TRUE")
-    fp = condorCommand(condor_job_status, cp, {'constraint': constraint})
+    condorXml = condorCommandBytes(condor_job_status, cp,
+        {'constraint': constraint})
     handler = ClassAdParser('GlobalJobId', ['JobStatus', 'Owner',
         'AccountingGroup', 'FlockFrom']);
 
     submitConstraint = _createSubmitterConstraint(cp)
-    fp2 = condorCommand(condor_status_submitter, cp, {'constraint': submitConstraint})
+    submitterXml = condorCommandBytes(condor_status_submitter, cp,
+        {'constraint': submitConstraint})
     handler2 = ClassAdParser('Name', ['MaxJobsRunning'])
     try:
-        xmlLine = ''
-        while xmlLine.find('<?xml') == -1: # Throw away junk lines from Condor < 7.3.2
-            xmlLine = fp.readline()
-        condorXml = cStringIO.StringIO(xmlLine+fp.read())
+        # Throw away junk lines from Condor < 7.3.2
+        xmlStart = condorXml.find('<?xml')
+        if xmlStart > 0:
+            condorXml = condorXml[xmlStart:]
         parseCondorXml(condorXml, handler)
     except Exception, e:
         log.error("Unable to parse condor output!")
@@ -468,7 +809,7 @@ def _getJobsInfoInternal(cp):
         if 'GIP_TESTING' in os.environ: raise RuntimeError('Could not parse condor_q -xml output!')
         return {}
     try:
-        parseCondorXml(fp2, handler2)
+        parseCondorXml(submitterXml, handler2)
     except Exception, e:
         log.error("Unable to parse condor output!")
         log.exception(e)
@@ -520,44 +861,53 @@ def getJobsInfo(vo_map, cp):
     @param cp: A ConfigParser object with the GIP config information.
     @returns: A dictionary containing job information.
     """
-    group_jobs = {}
-    queue_constraint = cp_get(cp, "condor", "jobs_constraint", "TRUE")
-    if queue_constraint.upper() == 'TRUE':
-        submitConstraint = _createSubmitterConstraint(cp)
-        fp = condorCommand(condor_status_submitter, cp, {'constraint': submitConstraint})
-        handler = ClassAdParser(('Name', 'ScheddName'), ['RunningJobs',
-            'IdleJobs', 'HeldJobs', 'MaxJobsRunning', 'FlockedJobs'])
-        try:
-            parseCondorXml(fp, handler)
-        except Exception, e:
-            log.error("Unable to parse condor output!")
-            log.exception(e)
-        results = handler.getClassAds()
-    else:
-        results = _getJobsInfoInternal(cp)
+    malformed_keys = sets.Set()
     def addIntInfo(my_info_dict, classad_dict, my_key, classad_key):
         """
         Add some integer info contained in classad_dict[classad_key] to 
-        my_info_dict[my_key]; protect against any thrown exceptions.
-        If classad_dict[classad_key] cannot be converted to a number,
-        default to 0.
+        my_info_dict[my_key].  The value may be a string from a classad or
+        an integer counted up by _getJobsInfoInternal.
+        If classad_dict[classad_key] is missing or not an integer, it is
+        ignored; the latter is logged once per classad attribute.
         """
-        if my_key not in my_info_dict or classad_key not in classad_dict:
-            return
         try:
-            new_info = int(classad_dict[classad_key])
-        except:
-            new_info = 0
-        my_info_dict[my_key] += new_info
+            value = int(classad_dict[classad_key])
+        except KeyError:
+            return
+        except ValueError:
+            if classad_key not in malformed_keys:
+                malformed_keys.add(classad_key)
+                log.debug("Ignoring non-integer value %s of classad " \
+                    "attribute %s." % (classad_dict[classad_key], classad_key))
+            return
+        my_info_dict[my_key] = my_info_dict.get(my_key, 0) + value
 
     all_group_info = getGroupInfo(vo_map, cp)
 
+    # The (my_info key, classad attribute) pairs summed for each submitter;
+    # decided once here rather than for every classad.
+    int_attrs = [("running", "RunningJobs")]
+    if cp_getBoolean(cp, "condor", "count_flocked", True):
+        int_attrs.append(("running", "FlockedJobs"))
+    int_attrs += [("idle", "IdleJobs"), ("held", "HeldJobs"),
+        ("max_running", "MaxJobsRunning")]
+
+    group_jobs = {}
     unknown_users = sets.Set()
-    for user, info in results.items():
+    # Users submit from many schedds; only map each of them to a VO once.
+    vo_cache = {}
+    def addJobsInfo(user, info):
+        """
+        Add the job counts of the submitter classad B{info} for B{user} to
+        the per-group, per-VO totals.
+        """
         # Determine the VO, or skip the entry
         if isinstance(user, types.TupleType):
             user = user[0]
-        name = user.split("@")[0]
+        name = user
+        at = name.find('@')
+        if at >= 0:
+            name = name[:at]
         name_info = name.rsplit('.', 1)
         if len(name_info) == 2:
             group, name = name_info
@@ -569,30 +919,45 @@ def getJobsInfo(vo_map, cp):
             group = 'default'
         log.debug("Examining jobs for group %s, user %s." % (group, name))
         try:
-            vo = vo_map[name].lower()
-        except Exception, e:
-            if name in all_group_info:
-                group = name
-                if len(all_group_info[name].get('vo', [])) == 1:
-                    vo = all_group_info[name]['vo']
-                else:
-                    vo = 'unknown'
-            else:
+            vo = vo_cache[name]
+        except KeyError:
+            try:
+                vo = vo_map[name].lower()
+            except Exception:
+                vo = None
+            vo_cache[name] = vo
+        if vo is None:
+            if name not in all_group_info:
                 unknown_users.add(name)
-            continue
+            return
 
         vo_jobs = group_jobs.setdefault(group, {})
 
         # Add the information to the current dictionary.
-        my_info = vo_jobs.get(vo, {"running":0, "idle":0, "held":0, \
-            'max_running':0})
-        addIntInfo(my_info, info, "running", "RunningJobs")
-        if cp_getBoolean(cp, "condor", "count_flocked", True):
-            addIntInfo(my_info, info, "running", "FlockedJobs")
-        addIntInfo(my_info, info, "idle", "IdleJobs")
-        addIntInfo(my_info, info, "held", "HeldJobs")
-        addIntInfo(my_info, info, "max_running", "MaxJobsRunning")
-        vo_jobs[vo] = my_info
+        my_info = vo_jobs.get(vo, None)
+        if my_info is None:
+            my_info = {"running":0, "idle":0, "held":0, 'max_running':0}
+            vo_jobs[vo] = my_info
+        for my_key, classad_key in int_attrs:
+            addIntInfo(my_info, info, my_key, classad_key)
+
+    queue_constraint = cp_get(cp, "condor", "jobs_constraint", "TRUE")
+    if queue_constraint.upper() == 'TRUE':
+        # Aggregate each submitter classad as soon as it is parsed.
+        submitConstraint = _createSubmitterConstraint(cp)
+        submitterXml = condorCommandBytes(condor_status_submitter, cp,
+            {'constraint': submitConstraint})
+        handler = ClassAdParser(('Name', 'ScheddName'), ['RunningJobs',
+            'IdleJobs', 'HeldJobs', 'MaxJobsRunning', 'FlockedJobs'],
+            on_classad=addJobsInfo)
+        try:
+            parseCondorXml(submitterXml, handler, strict=False)
+        except Exception, e:
+            log.error("Unable to parse condor output!")
+            log.exception(e)
+    else:
+        for user, info in _getJobsInfoInternal(cp).items():
+            addJobsInfo(user, info)
 
     log.warning("The following users are non-grid users: %s" % \
         ", ".join(unknown_users))
@@ -615,22 +980,20 @@ def parseNodes(cp):
     subtract = cp_getBoolean(cp, "condor", "subtract_owner", True)
     log.debug("Parsing condor nodes.")
     constraint = cp_get(cp, "condor", "status_constraint", "TRUE")
-    fp = condorCommand(condor_status, cp, {'constraint': constraint})
-    handler = ClassAdParser('Name', ['State'])
-    parseCondorXml(fp, handler)
-    total = 0
-    claimed = 0
-    unclaimed = 0
-    for info in handler.getClassAds().values():
-        total += 1
-        if 'State' not in info:
-            continue
-        if info['State'] == 'Claimed':
-            claimed += 1
-        elif info['State'] == 'Unclaimed':
-            unclaimed += 1
-        elif subtract and info['State'] == 'Owner':
-            total -= 1
+    statusXml = condorCommandBytes(condor_status, cp, {'constraint': constraint})
+    states = []
+    def addState(name, info):
+        """
+        Record the state of one slot; the classad itself is not kept.
+        """
+        states.append(info.get('State', None))
+    handler = ClassAdParser('Name', ['State'], on_classad=addState)
+    parseCondorXml(statusXml, handler, strict=False)
+    total = len(states)
+    claimed = states.count('Claimed')
+    unclaimed = states.count('Unclaimed')
+    if subtract:
+        total -= states.count('Owner')
     log.info("There are %i total; %i claimed and %i unclaimed." % \
              (total, claimed, unclaimed))
     _nodes_cache = total, claimed, unclaimed
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import glob
 import socket
 import unittest
 
@@ -207,6 +208,73 @@ class TestCondorProvider(unittest.TestCase):
         entries = read_ldap(fd, multi=True)
         self.assertEquals(fd.close(), None)
 
+    def test_condorq_jobs(self):
+        """
+        Make sure the job counts from condor_q (used when jobs_constraint is
+        set) are aggregated into the VO totals.
+        """
+        ce = 'cmsgrid02.hep.wisc.edu:2119/jobmanager-condor-default'
+        for suffix in ['glow', 'glow-condor72']:
+            os.environ['GIP_TESTING'] = 'suffix=%s' % suffix
+            path = os.path.expandvars("$GIP_LOCATION/libexec/osg_info_" \
+                "provider_condor.py --config=test_configs/glow_condorq.conf")
+            fd = os.popen(path)
+            entries = read_ldap(fd, multi=True)
+            self.assertEquals(fd.close(), None)
+            entry = self.check_for_ce(ce, entries)
+            self.failUnless('9' in entry.glue['CEStateWaitingJobs'], msg= \
+                "Did not count the idle jobs from condor_q (%s)." % suffix)
+
+    def parse_classads(self, data, idx, attrlist, mode):
+        """
+        Parse the Condor XML in data with the SAX parser ('sax'), iterparse
+        ('tree') or the non-strict scanner ('scan'); returns the classads.
+        """
+        import condor_common
+        handler = condor_common.ClassAdParser(idx, attrlist)
+        old_etree = condor_common.etree
+        old_block_size = condor_common._scan_block_size
+        try:
+            if mode == 'sax':
+                condor_common.etree = None
+            condor_common._scan_block_size = 100
+            condor_common.parseCondorXml(data, handler, strict=(mode != 'scan'))
+        finally:
+            condor_common.etree = old_etree
+            condor_common._scan_block_size = old_block_size
+        return handler.getClassAds()
+
+    def test_xml_parsers(self):
+        """
+        Make sure the SAX parser, iterparse and the non-strict scanner all
+        read the same classads from the sample condor_* -xml output.
+        """
+        cases = [('Name', ['State']),
+            (('Name', 'ScheddName'), ['RunningJobs', 'IdleJobs', 'HeldJobs']),
+            ('GlobalJobId', ['JobStatus', 'Owner', 'AccountingGroup']),
+            ('Name', [])]
+        files = glob.glob('command_output/condor_*xml*')
+        self.failUnless(files, msg="No condor XML samples found.")
+        samples = []
+        for filename in files:
+            data = open(filename).read()
+            samples.append((filename, data[data.find('<?xml'):]))
+        samples.append(('entities', '<?xml version="1.0"?>\n<classads><c>' \
+            '<a n="Name"><s>&#65;&#x42;&amp;#67;&lt;&quot;</s></a>' \
+            '<a n="State"><s>Claimed</s></a></c></classads>\n'))
+        for filename, data in samples:
+            for idx, attrlist in cases:
+                sax = self.parse_classads(data, idx, attrlist, 'sax')
+                tree = self.parse_classads(data, idx, attrlist, 'tree')
+                scan = self.parse_classads(data, idx, attrlist, 'scan')
+                self.assertEquals(sax, tree, msg="iterparse differs from " \
+                    "SAX for %s" % filename)
+                self.assertEquals(sax, scan, msg="Scanner differs from " \
+                    "SAX for %s" % filename)
+        classads = self.parse_classads(samples[-1][1], 'Name', [], 'scan')
+        self.failUnless('AB&#67;<"' in classads, msg="Scanner did not decode" \
+            " the character references.")
+
 
     def test_collector_host(self):
         """